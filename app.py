@@ -3,6 +3,8 @@ from flask import Flask, request, jsonify
 import asyncio
 import configparser
 from graph import Graph
+from mail_queue import MailQueue
+from network_index import InteractionIndex, IndexSync
 import nest_asyncio
 
 # Apply nest_asyncio to fix event loop issues
@@ -15,6 +17,29 @@ config = configparser.ConfigParser()
 config.read(['config.cfg', 'config.dev.cfg'])
 azure_settings = config['azure']
 
+# Outbound mail is delivered in the background; see mail_queue.py
+mail_queue = MailQueue(
+    azure_settings,
+    db_path=config.get('mail_queue', 'dbPath', fallback='data/mail_queue.db'),
+    workers=config.getint('mail_queue', 'workers', fallback=4),
+    rate_per_minute=config.getint('mail_queue', 'ratePerMinute', fallback=30),
+    max_attempts=config.getint('mail_queue', 'maxAttempts', fallback=5),
+    retention_days=config.getfloat('mail_queue', 'retentionDays', fallback=7)
+)
+mail_queue.start()
+
+# Who-talks-to-whom index, kept current from the inbox and sent items in the background
+network_index = InteractionIndex(
+    half_life_days=config.getfloat('network_index', 'halfLifeDays', fallback=30.0)
+)
+network_index_sync = IndexSync(
+    azure_settings,
+    network_index,
+    interval=config.getfloat('network_index', 'syncInterval', fallback=300),
+    initial_days=config.getint('network_index', 'initialDays', fallback=90)
+)
+network_index_sync.start()
+
 @app.route('/options', methods=['GET'])
 def options():
     options_list = [
@@ -25,7 +50,8 @@ def options():
         {'id': 4, 'name': 'Extract email metadata'},
         {'id': 5, 'name': 'Extract calendar events'},
         {'id': 6, 'name': 'Extract contacts and network'},
-        {'id': 7, 'name': 'Extract SharePoint usage'}
+        {'id': 7, 'name': 'Extract SharePoint usage'},
+        {'id': 8, 'name': 'Get communication network'}
     ]
     return jsonify(options_list)
 
@@ -43,13 +69,49 @@ def interact():
         search_term = data.get('search_term', '')
         
         # Process the selected option
-        result = asyncio.run(process_option(option, search_term))
+        result = asyncio.run(process_option(option, search_term, data.get('mail')))
         return jsonify(result)
 
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/mail', methods=['POST'])
+def submit_mail():
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Missing mail in request'}), 400
+
+        # Accept a single mail or a list of mails (e.g. one digest per user)
+        if isinstance(data, list):
+            job_ids = mail_queue.submit_many(data)
+            return jsonify({'job_ids': job_ids}), 202
+        job_id = mail_queue.submit_many([data])[0]
+        return jsonify({'job_id': job_id}), 202
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-async def process_option(option, search_term=''):
+@app.route('/mail/<job_id>', methods=['GET'])
+def mail_status(job_id):
+    job = mail_queue.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found.'}), 404
+    return jsonify(job)
+
+async def index_email_metadata(graph_instance, metadata):
+    # Exclude the mailbox owner from the index; they are on every message
+    if network_index.owner is None:
+        user = await graph_instance.get_user()
+        if user and (user.mail or user.user_principal_name):
+            network_index.owner = (user.mail or user.user_principal_name).lower()
+    network_index.update(metadata)
+
+async def process_option(option, search_term='', mail=None):
     # Initialize Graph object inside the async function to ensure it uses the same event loop
     graph_instance = Graph(azure_settings)
 
@@ -74,18 +136,24 @@ async def process_option(option, search_term=''):
         else:
             return {'messages': [], 'more_available': False}
     elif option == 3:
-        # Send mail to the signed-in user
-        user = await graph_instance.get_user()
-        if user:
-            user_email = user.mail or user.user_principal_name
-            await graph_instance.send_mail('Testing Microsoft Graph', 'Hello world!', user_email or '')
-            return {'message': 'Mail sent.'}
-        else:
-            return {'error': 'User not found.'}, 500
+        # Queue the given mail, or a test mail to the signed-in user if none was given
+        if mail is not None and not isinstance(mail, dict):
+            raise ValueError('mail must be a JSON object')
+        mail = dict(mail or {})
+        if not (mail.get('to') or mail.get('cc') or mail.get('bcc')):
+            user = await graph_instance.get_user()
+            if not user:
+                return {'error': 'User not found.'}, 500
+            mail['to'] = user.mail or user.user_principal_name
+        mail.setdefault('subject', 'Testing Microsoft Graph')
+        mail.setdefault('body', 'Hello world!')
+        job_id = mail_queue.submit_many([mail])[0]
+        return {'message': 'Mail queued.', 'job_id': job_id}
     elif option == 4:
         # Call the enriched extract_email_metadata function
         metadata = await graph_instance.extract_email_metadata()
         if metadata:
+            await index_email_metadata(graph_instance, metadata)
             return {'email_metadata': metadata}
         else:
             return {'email_metadata': []}
@@ -130,6 +198,15 @@ async def process_option(option, search_term=''):
             return {'sharepoint_sites': site_list}
         else:
             return {'sharepoint_sites': []}
+    elif option == 8:
+        # Answered from the index alone; it is kept current by network_index_sync
+        if search_term:
+            contact = network_index.contact(search_term)
+            if contact:
+                return {'contact': contact}
+            else:
+                return {'error': f"No interactions found for '{search_term}'."}
+        return {'communication_network': network_index.summary()}
     else:
         return {'error': 'Invalid option.'}, 400
 
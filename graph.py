@@ -1,4 +1,6 @@
 from configparser import SectionProxy
+from datetime import datetime, timezone
+import httpx
 from azure.identity.aio import ClientSecretCredential
 from msgraph import GraphServiceClient
 from msgraph.generated.users.item.user_item_request_builder import UserItemRequestBuilder
@@ -12,6 +14,8 @@ from msgraph.generated.models.email_address import EmailAddress
 from msgraph.generated.users.item.calendar.events.events_request_builder import EventsRequestBuilder
 from msgraph.generated.sites.sites_request_builder import SitesRequestBuilder
 
+EMAIL_METADATA_FIELDS = ['id', 'from', 'isRead', 'receivedDateTime', 'subject', 'toRecipients', 'ccRecipients', 'importance', 'hasAttachments', 'categories']
+
 class Graph:
     settings: SectionProxy
     client_credential: ClientSecretCredential
@@ -79,6 +83,38 @@ class Graph:
 
         await self.app_client.users.by_user_id(self.user_id).send_mail.post(body=request_body)
 
+    async def send_mail_batch(self, messages: dict, token: str, timeout: float = 60):
+        # messages maps a request id to a Graph message resource (JSON form).
+        # Graph accepts at most 20 requests per $batch call. The token is passed in
+        # so callers can tell a token failure apart from a failed post.
+        # Each request depends on the previous one, so Graph runs them one at a time and
+        # the batch uses a single slot of the mailbox's concurrent request limit.
+        # If a request fails, the ones after it fail with 424 Failed Dependency.
+        requests = []
+        for request_id, message in messages.items():
+            request = {
+                'id': request_id,
+                'method': 'POST',
+                'url': f'/users/{self.user_id}/sendMail',
+                'headers': {'Content-Type': 'application/json'},
+                'body': {'message': message, 'saveToSentItems': True}
+            }
+            if requests:
+                request['dependsOn'] = [requests[-1]['id']]
+            requests.append(request)
+        batch_body = {'requests': requests}
+
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            response = await client.post(
+                'https://graph.microsoft.com/v1.0/$batch',
+                headers={'Authorization': f'Bearer {token}'},
+                json=batch_body
+            )
+        response.raise_for_status()
+
+        # Return the individual responses keyed by request id
+        return {item['id']: item for item in response.json().get('responses', [])}
+
     async def extract_inference_data(self):
         await self.extract_email_metadata()
         await self.extract_calendar_events()
@@ -87,7 +123,7 @@ class Graph:
 
     async def extract_email_metadata(self):
         query_params = MessagesRequestBuilder.MessagesRequestBuilderGetQueryParameters(
-            select=['from', 'isRead', 'receivedDateTime', 'subject', 'toRecipients', 'ccRecipients', 'importance', 'hasAttachments', 'categories'],
+            select=EMAIL_METADATA_FIELDS,
             top=25,
             orderby=['receivedDateTime DESC']
         )
@@ -98,20 +134,7 @@ class Graph:
         messages = await self.app_client.users.by_user_id(self.user_id).mail_folders.by_mail_folder_id('inbox').messages.get(
             request_configuration=request_config)
 
-        email_metadata = []
-        for message in messages.value:
-            metadata = {
-                "subject": message.subject,
-                "from": message.from_.email_address.address if message.from_ and message.from_.email_address else "N/A",
-                "received_date_time": message.received_date_time.strftime('%Y-%m-%d %H:%M:%S%z'),
-                "is_read": message.is_read,
-                "to_recipients": [recipient.email_address.address for recipient in message.to_recipients] if message.to_recipients else [],
-                "cc_recipients": [recipient.email_address.address for recipient in message.cc_recipients] if message.cc_recipients else [],
-                "importance": message.importance.value if message.importance else "normal",
-                "has_attachments": message.has_attachments,
-                "categories": message.categories if message.categories else []
-            }
-            email_metadata.append(metadata)
+        email_metadata = [self._message_metadata(message) for message in messages.value]
 
         # Print the enriched metadata
         for metadata in email_metadata:
@@ -129,6 +152,44 @@ class Graph:
         # Return the enriched metadata
         return email_metadata
 
+    async def get_email_metadata_since(self, folder: str, since: datetime):
+        # Pages through every message in the folder received at or after since (UTC), oldest first
+        query_params = MessagesRequestBuilder.MessagesRequestBuilderGetQueryParameters(
+            select=EMAIL_METADATA_FIELDS,
+            filter=f"receivedDateTime ge {since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}",
+            top=100,
+            orderby=['receivedDateTime ASC']
+        )
+        request_config = MessagesRequestBuilder.MessagesRequestBuilderGetRequestConfiguration(
+            query_parameters=query_params
+        )
+
+        messages_builder = self.app_client.users.by_user_id(self.user_id).mail_folders.by_mail_folder_id(folder).messages
+        messages = await messages_builder.get(request_configuration=request_config)
+
+        email_metadata = []
+        while messages:
+            email_metadata.extend(self._message_metadata(message) for message in messages.value or [])
+            if not messages.odata_next_link:
+                break
+            messages = await messages_builder.with_url(messages.odata_next_link).get()
+        return email_metadata
+
+    @staticmethod
+    def _message_metadata(message):
+        return {
+            "id": message.id,
+            "subject": message.subject,
+            "from": message.from_.email_address.address if message.from_ and message.from_.email_address else "N/A",
+            "received_date_time": message.received_date_time.strftime('%Y-%m-%d %H:%M:%S%z'),
+            "is_read": message.is_read,
+            "to_recipients": [recipient.email_address.address for recipient in message.to_recipients] if message.to_recipients else [],
+            "cc_recipients": [recipient.email_address.address for recipient in message.cc_recipients] if message.cc_recipients else [],
+            "importance": message.importance.value if message.importance else "normal",
+            "has_attachments": message.has_attachments,
+            "categories": message.categories if message.categories else []
+        }
+
     async def extract_calendar_events(self):
         query_params = EventsRequestBuilder.EventsRequestBuilderGetQueryParameters(
             select=['subject', 'start', 'end', 'location'],
@@ -0,0 +1,429 @@
+# mail_queue.py
+import asyncio
+import html
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from configparser import SectionProxy
+from contextlib import contextmanager
+from string import Template
+
+import httpx
+
+from graph import Graph
+
+logger = logging.getLogger(__name__)
+
+# Graph accepts at most 20 requests per $batch call
+BATCH_LIMIT = 20
+BATCH_TIMEOUT_SECONDS = 60
+# Outlook allows 4 concurrent requests per app per mailbox. Each batch is sent as
+# one dependsOn chain, so it takes one of these slots; at most one batch per worker.
+MAILBOX_CONCURRENCY = 4
+# A 'sending' job whose claim is older than this was abandoned by its worker
+LEASE_SECONDS = BATCH_TIMEOUT_SECONDS * 2
+# Per-message statuses worth retrying: throttling and transient server errors
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Whole-batch statuses worth retrying; Graph ran none of the requests
+BATCH_RETRYABLE_STATUSES = {429, 503}
+# Whole-batch statuses after which some requests may already have run
+BATCH_UNKNOWN_STATUSES = {500, 502, 504}
+MAX_BACKOFF_SECONDS = 300
+# How often finished jobs past their retention period are deleted
+PURGE_INTERVAL_SECONDS = 3600
+
+
+# Token bucket shared by the queue workers
+class RateLimiter:
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.tokens = float(rate_per_minute)
+        self.fill_rate = rate_per_minute / 60.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # Hold every worker back while Graph is throttling the mailbox
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def release(self, count: int):
+        self.tokens = min(self.capacity, self.tokens + count)
+
+    async def acquire(self, count: int):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                await asyncio.sleep((count - self.tokens) / self.fill_rate)
+
+
+# Durable outbound mail queue: jobs are persisted to SQLite on submission and
+# delivered in the background by async workers that group them into $batch calls.
+# Delivery is at-least-once: a job whose worker died mid-send is retried once its
+# lease expires, and Graph has no way to deduplicate the resulting message.
+# Sends whose outcome cannot be known (e.g. a timeout after the batch was posted)
+# are not retried; they end in the 'unknown' status instead.
+class MailQueue:
+    def __init__(self, config: SectionProxy, db_path: str = 'data/mail_queue.db', workers: int = 4,
+                 rate_per_minute: int = 30, max_attempts: int = 5, poll_interval: float = 1.0,
+                 retention_days: float = 7):
+        if not 1 <= workers <= MAILBOX_CONCURRENCY:
+            raise ValueError(f'workers must be between 1 and {MAILBOX_CONCURRENCY}')
+        if rate_per_minute <= 0:
+            raise ValueError('rate_per_minute must be positive')
+
+        self.settings = config
+        self.db_path = db_path
+        self.workers = workers
+        self.rate_per_minute = rate_per_minute
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retention_days = retention_days
+
+        self._last_purge = 0.0
+        self._loop = None
+        self._wakeup = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS mail_jobs (
+                    id TEXT PRIMARY KEY,
+                    idempotency_key TEXT UNIQUE NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_mail_jobs_pending ON mail_jobs (status, next_attempt_at)')
+
+    # Submission
+
+    def submit_many(self, mails: list):
+        # Validate everything before writing so a bad entry doesn't leave a partial submission
+        jobs = [self._prepare_job(mail) for mail in mails]
+        now = time.time()
+        job_ids = []
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for key, payload in jobs:
+                    existing = conn.execute('SELECT id FROM mail_jobs WHERE idempotency_key = ?', (key,)).fetchone()
+                    if existing:
+                        # Same idempotency key already submitted: hand back the original job
+                        job_ids.append(existing['id'])
+                        continue
+                    job_id = uuid.uuid4().hex
+                    conn.execute(
+                        'INSERT INTO mail_jobs (id, idempotency_key, payload, status, next_attempt_at, created_at, updated_at) '
+                        "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                        (job_id, key, json.dumps(payload), now, now, now)
+                    )
+                    job_ids.append(job_id)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+        self._notify()
+        return job_ids
+
+    @staticmethod
+    def _as_list(value, field: str):
+        if not value:
+            return []
+        if isinstance(value, str):
+            return [value]
+        if isinstance(value, list) and all(isinstance(address, str) for address in value):
+            return value
+        raise ValueError(f'{field} must be an email address or a list of email addresses')
+
+    def _prepare_job(self, mail: dict):
+        if not isinstance(mail, dict):
+            raise ValueError('Each mail must be a JSON object')
+
+        to = self._as_list(mail.get('to'), 'to')
+        cc = self._as_list(mail.get('cc'), 'cc')
+        bcc = self._as_list(mail.get('bcc'), 'bcc')
+        if not (to or cc or bcc):
+            raise ValueError('At least one recipient (to, cc or bcc) is required')
+
+        subject = mail.get('subject') or ''
+        body = mail.get('body') or ''
+        if not subject:
+            raise ValueError('Subject is required')
+        if not isinstance(subject, str) or not isinstance(body, str):
+            raise ValueError('subject and body must be strings')
+
+        content_type = mail.get('content_type') or 'text'
+        if not isinstance(content_type, str) or content_type.lower() not in ('text', 'html'):
+            raise ValueError("content_type must be 'text' or 'html'")
+        content_type = content_type.lower()
+
+        template_vars = mail.get('template_vars')
+        if template_vars:
+            if not isinstance(template_vars, dict):
+                raise ValueError('template_vars must be a JSON object')
+            subject = Template(subject).safe_substitute(template_vars)
+            if content_type == 'html':
+                # Values are data, not markup
+                template_vars = {name: html.escape(str(value)) for name, value in template_vars.items()}
+            body = Template(body).safe_substitute(template_vars)
+
+        payload = {
+            'to': to, 'cc': cc, 'bcc': bcc, 'subject': subject,
+            'body': body, 'content_type': content_type
+        }
+        key = mail.get('idempotency_key') or uuid.uuid4().hex
+        if not isinstance(key, str):
+            raise ValueError('idempotency_key must be a string')
+        return key, payload
+
+    # Status
+
+    def get_job(self, job_id: str):
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM mail_jobs WHERE id = ?', (job_id,)).fetchone()
+        if not row:
+            return None
+
+        payload = json.loads(row['payload'])
+        return {
+            'job_id': row['id'],
+            'idempotency_key': row['idempotency_key'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'last_error': row['last_error'],
+            'subject': payload['subject'],
+            'to': payload['to'],
+            'cc': payload['cc'],
+            'bcc': payload['bcc'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        }
+
+    # Workers
+
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(ready,), name='mail-queue', daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def _run(self, ready: threading.Event):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._wakeup = asyncio.Event()
+        ready.set()
+        self._loop.run_until_complete(self._serve())
+
+    async def _serve(self):
+        # The Graph client must be created on the loop that will use it
+        graph_instance = Graph(self.settings)
+        limiter = RateLimiter(self.rate_per_minute)
+        await asyncio.gather(*(self._worker(graph_instance, limiter) for _ in range(self.workers)))
+
+    def _notify(self):
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _worker(self, graph_instance: Graph, limiter: RateLimiter):
+        batch_size = min(BATCH_LIMIT, self.rate_per_minute)
+        while True:
+            try:
+                sent = await self._send_next_batch(graph_instance, limiter, batch_size)
+            except Exception:
+                # Keep the worker alive; jobs it had claimed are picked up again when their lease expires
+                logger.exception('Mail queue worker failed')
+                sent = False
+
+            if not sent:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _send_next_batch(self, graph_instance: Graph, limiter: RateLimiter, batch_size: int):
+        # Take the rate limit tokens before claiming, so claimed jobs are sent straight away
+        await limiter.acquire(batch_size)
+        jobs = self._claim(batch_size)
+        limiter.release(batch_size - len(jobs))
+        if not jobs:
+            return False
+
+        messages = {job['id']: self._build_message(job) for job in jobs}
+        try:
+            token = await graph_instance.get_app_only_token()
+        except Exception as e:
+            # Nothing was posted, so it is safe to send again
+            for job in jobs:
+                self._record_failure(job, f'Could not get an access token: {e!r}', True, None)
+            return True
+
+        try:
+            responses = await graph_instance.send_mail_batch(messages, token, timeout=BATCH_TIMEOUT_SECONDS)
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            retry_after = e.response.headers.get('Retry-After')
+            if status == 429:
+                limiter.pause(self._retry_delay(jobs[0], retry_after))
+            for job in jobs:
+                if status == 429:
+                    self._record_throttled(job, 'Batch request throttled: 429', retry_after)
+                elif status in BATCH_UNKNOWN_STATUSES:
+                    self._mark(job['id'], 'unknown', f'Batch request failed: {status}')
+                else:
+                    # Any other rejection of the batch itself means none of its mails were sent
+                    self._record_failure(job, f'Batch request failed: {status}', status in BATCH_RETRYABLE_STATUSES, retry_after)
+            return True
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # The batch never reached Graph, so it is safe to send again
+            for job in jobs:
+                self._record_failure(job, f'Batch request failed: {e}', True, None)
+            return True
+        except Exception as e:
+            # Graph may or may not have accepted the batch; retrying could send duplicates
+            for job in jobs:
+                self._mark(job['id'], 'unknown', f'Batch request outcome unknown: {e!r}')
+            return True
+
+        for job in jobs:
+            response = responses.get(job['id'])
+            if response is None:
+                self._mark(job['id'], 'unknown', 'No response for request in batch')
+                continue
+            status = response.get('status', 0)
+            retry_after = (response.get('headers') or {}).get('Retry-After')
+            error = f"{status} {(response.get('body') or {}).get('error', {}).get('message', '')}".strip()
+            if 200 <= status < 300:
+                self._mark(job['id'], 'sent')
+            elif status == 429:
+                limiter.pause(self._retry_delay(job, retry_after))
+                self._record_throttled(job, error, retry_after)
+            elif status == 424:
+                # Skipped because an earlier request in the chain failed; it was never attempted
+                self._record_throttled(job, error, 0)
+            else:
+                self._record_failure(job, error, status in RETRYABLE_STATUSES, retry_after)
+        return True
+
+    def _claim(self, limit: int):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Requeue jobs whose worker has held them longer than any send can take
+                conn.execute(
+                    "UPDATE mail_jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                    "last_error = 'Lease expired while sending', next_attempt_at = ?, updated_at = ? "
+                    "WHERE status = 'sending' AND updated_at < ?",
+                    (self.max_attempts, now, now, now - LEASE_SECONDS)
+                )
+                rows = conn.execute(
+                    "SELECT id, idempotency_key, payload, attempts FROM mail_jobs "
+                    "WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE mail_jobs SET status = 'sending', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    [(now, row['id']) for row in rows]
+                )
+                if now - self._last_purge >= PURGE_INTERVAL_SECONDS:
+                    # Finished jobs keep their mail body; drop them once past retention
+                    conn.execute(
+                        "DELETE FROM mail_jobs WHERE status IN ('sent', 'failed', 'unknown') AND updated_at < ?",
+                        (now - self.retention_days * 86400,)
+                    )
+                    self._last_purge = now
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return [
+            {'id': row['id'], 'idempotency_key': row['idempotency_key'],
+             'payload': json.loads(row['payload']), 'attempts': row['attempts'] + 1}
+            for row in rows
+        ]
+
+    @staticmethod
+    def _build_message(job: dict):
+        payload = job['payload']
+
+        def recipients(addresses):
+            return [{'emailAddress': {'address': address}} for address in addresses]
+
+        message = {
+            'subject': payload['subject'],
+            'body': {
+                'contentType': 'HTML' if payload['content_type'] == 'html' else 'Text',
+                'content': payload['body']
+            },
+            'toRecipients': recipients(payload['to']),
+            # Graph does not deduplicate on this; it only lets a redelivered message be recognised
+            'internetMessageHeaders': [{'name': 'X-Idempotency-Key', 'value': job['idempotency_key']}]
+        }
+        if payload['cc']:
+            message['ccRecipients'] = recipients(payload['cc'])
+        if payload['bcc']:
+            message['bccRecipients'] = recipients(payload['bcc'])
+        return message
+
+    @staticmethod
+    def _retry_delay(job: dict, retry_after):
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return min(2 ** job['attempts'], MAX_BACKOFF_SECONDS)
+
+    def _record_failure(self, job: dict, error: str, retryable: bool, retry_after):
+        if not retryable or job['attempts'] >= self.max_attempts:
+            self._mark(job['id'], 'failed', error)
+            return
+        self._mark(job['id'], 'queued', error, time.time() + self._retry_delay(job, retry_after))
+
+    def _record_throttled(self, job: dict, error: str, retry_after):
+        # The mail was never rejected, so this attempt doesn't count towards max_attempts
+        self._mark(job['id'], 'queued', error, time.time() + self._retry_delay(job, retry_after), refund_attempt=True)
+
+    def _mark(self, job_id: str, status: str, error=None, next_attempt_at=None, refund_attempt=False):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE mail_jobs SET status = ?, last_error = ?, next_attempt_at = COALESCE(?, next_attempt_at), '
+                'attempts = attempts - ?, updated_at = ? WHERE id = ?',
+                (status, error, next_attempt_at, 1 if refund_attempt else 0, now, job_id)
+            )
@@ -0,0 +1,354 @@
+# network_index.py
+import asyncio
+import hashlib
+import heapq
+import logging
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from configparser import SectionProxy
+from datetime import datetime, timedelta, timezone
+
+from graph import Graph
+
+logger = logging.getLogger(__name__)
+
+# A contact's interaction weight halves after this many days without new mail
+DEFAULT_HALF_LIFE_DAYS = 30.0
+# Two co-recipients are linked in a cluster when their decayed co-recipient weight
+# reaches CLUSTER_MIN_WEIGHT and is at least CLUSTER_RELATIVE_WEIGHT of the strongest
+# link of either of them, so one occasional bridging message doesn't merge two teams
+CLUSTER_MIN_WEIGHT = 2.0
+CLUSTER_RELATIVE_WEIGHT = 0.75
+# Clusters kept from each rebuild, and members listed per cluster
+CLUSTER_LIMIT = 20
+CLUSTER_MEMBER_LIMIT = 10
+# Folders the index is synced from
+SYNC_FOLDERS = ('inbox', 'sentitems')
+
+
+# Incrementally maintained index of who the user corresponds with. Contacts are
+# interned to integer ids and their statistics live in parallel arrays, so
+# queries never need to re-read the mailbox.
+class InteractionIndex:
+    def __init__(self, owner=None, half_life_days: float = DEFAULT_HALF_LIFE_DAYS):
+        self.owner = owner.lower() if owner else None
+        self.decay_rate = math.log(2) / (half_life_days * 86400)
+
+        self.ids = {}                    # address -> contact id
+        self.addresses = []              # contact id -> address
+        self.weight = array('d')         # decayed interaction weight as of last_seen
+        self.last_seen = array('d')      # timestamp of the latest message involving the contact
+        self.sent = array('I')           # messages the contact sent to the user
+        self.addressed = array('I')      # messages the user sent to the contact
+        self.shared = array('I')         # messages the contact was a co-recipient on with the user
+        self.neighbours = []             # contact id -> {other contact id: shared message count}
+
+        # Every contact decays at the same rate, so log(weight) + decay_rate * last_seen
+        # ranks contacts the same at any query time. ranking holds (-rank, contact id)
+        # in order, which makes top-k a slice.
+        self.rank = array('d')
+        self.ranking = []
+
+        # Co-recipient edges (sender-recipient pairs are left out), with lazily decayed weights
+        self.edge_ids = {}               # (id_a << 32 | id_b), id_a < id_b -> edge id
+        self.edge_a = array('I')
+        self.edge_b = array('I')
+        self.edge_weight = array('d')    # decayed weight as of edge_last
+        self.edge_last = array('d')
+
+        # Rebuilt from the edges by rebuild_clusters(): lists of contact ids, largest first
+        self.cluster_cache = []
+
+        self.indexed_messages = 0
+        # 8-byte message id hash -> received timestamp, kept only for messages a sync may fetch again
+        self.seen_messages = {}
+        self.seen_from = 0.0             # messages received before this were all indexed by a sync
+        self.synced_until = {}           # folder -> latest received timestamp indexed from it
+        self.lock = threading.Lock()
+
+    def _contact_id(self, address: str):
+        contact_id = self.ids.get(address)
+        if contact_id is None:
+            contact_id = len(self.addresses)
+            self.ids[address] = contact_id
+            self.addresses.append(address)
+            self.weight.append(0.0)
+            self.last_seen.append(0.0)
+            self.sent.append(0)
+            self.addressed.append(0)
+            self.shared.append(0)
+            self.neighbours.append({})
+            self.rank.append(0.0)
+        return contact_id
+
+    def _decayed_add(self, weights: array, lasts: array, index: int, timestamp: float):
+        # Decay lazily: the stored weight is only valid as of the stored timestamp
+        last = lasts[index]
+        if timestamp >= last:
+            weights[index] = weights[index] * math.exp(-self.decay_rate * (timestamp - last)) + 1.0
+            lasts[index] = timestamp
+        else:
+            weights[index] += math.exp(-self.decay_rate * (last - timestamp))
+
+    def _bump(self, contact_id: int, timestamp: float):
+        if self.weight[contact_id] > 0:
+            old = (-self.rank[contact_id], contact_id)
+            del self.ranking[bisect_left(self.ranking, old)]
+        self._decayed_add(self.weight, self.last_seen, contact_id, timestamp)
+        self.rank[contact_id] = math.log(self.weight[contact_id]) + self.decay_rate * self.last_seen[contact_id]
+        insort(self.ranking, (-self.rank[contact_id], contact_id))
+
+    def _bump_edge(self, id_a: int, id_b: int, timestamp: float):
+        key = id_a << 32 | id_b
+        edge_id = self.edge_ids.get(key)
+        if edge_id is None:
+            edge_id = len(self.edge_a)
+            self.edge_ids[key] = edge_id
+            self.edge_a.append(id_a)
+            self.edge_b.append(id_b)
+            self.edge_weight.append(0.0)
+            self.edge_last.append(0.0)
+        self._decayed_add(self.edge_weight, self.edge_last, edge_id, timestamp)
+
+    def _normalize(self, address):
+        address = (address or '').strip().lower()
+        if not address or address == 'n/a' or address == self.owner:
+            return None
+        return address
+
+    @staticmethod
+    def _message_key(metadata: dict):
+        message_id = metadata.get('id') or repr((metadata.get('received_date_time'), metadata.get('from'), metadata.get('subject')))
+        return int.from_bytes(hashlib.blake2b(message_id.encode(), digest_size=8).digest(), 'big')
+
+    # Updates
+
+    def update(self, email_metadata: list, folder=None):
+        # Accepts the dicts returned by Graph.extract_email_metadata; returns the number of new messages indexed.
+        # When folder is given, also advances that folder's sync position.
+        added = 0
+        with self.lock:
+            for metadata in email_metadata:
+                # Read every field before touching the index, so a bad message leaves no partial counts
+                message_key = self._message_key(metadata)
+                timestamp = self._parse_time(metadata.get('received_date_time'))
+                if message_key in self.seen_messages or timestamp < self.seen_from:
+                    continue
+
+                sender_address = (metadata.get('from') or '').strip().lower()
+                from_owner = self.owner is not None and sender_address == self.owner
+                sender = self._normalize(sender_address)
+                recipients = [self._normalize(address) for address in
+                              list(metadata.get('to_recipients') or []) + list(metadata.get('cc_recipients') or [])]
+
+                participants = set()
+                if sender:
+                    sender_id = self._contact_id(sender)
+                    self.sent[sender_id] += 1
+                    participants.add(sender_id)
+
+                co_recipients = set()
+                for address in recipients:
+                    if not address:
+                        continue
+                    contact_id = self._contact_id(address)
+                    co_recipients.add(contact_id)
+                    if contact_id in participants:
+                        continue
+                    if from_owner:
+                        self.addressed[contact_id] += 1
+                    else:
+                        self.shared[contact_id] += 1
+                    participants.add(contact_id)
+
+                for contact_id in participants:
+                    self._bump(contact_id, timestamp)
+                    neighbours = self.neighbours[contact_id]
+                    for other_id in participants:
+                        if other_id != contact_id:
+                            neighbours[other_id] = neighbours.get(other_id, 0) + 1
+
+                ordered = sorted(co_recipients)
+                for i, id_a in enumerate(ordered):
+                    for id_b in ordered[i + 1:]:
+                        self._bump_edge(id_a, id_b, timestamp)
+
+                self.seen_messages[message_key] = timestamp
+                self.indexed_messages += 1
+                if folder:
+                    self.synced_until[folder] = max(self.synced_until.get(folder, 0.0), timestamp)
+                added += 1
+
+            self._prune_seen_messages()
+        return added
+
+    def _prune_seen_messages(self):
+        # Syncs fetch from each folder's synced_until onwards, so only messages at or after
+        # the earliest of those can be fetched again and need deduplicating
+        if not all(folder in self.synced_until for folder in SYNC_FOLDERS):
+            return
+        self.seen_from = min(self.synced_until[folder] for folder in SYNC_FOLDERS)
+        self.seen_messages = {key: timestamp for key, timestamp in self.seen_messages.items() if timestamp >= self.seen_from}
+
+    @staticmethod
+    def _parse_time(value):
+        if not value:
+            return time.time()
+        try:
+            return datetime.strptime(value, '%Y-%m-%d %H:%M:%S%z').timestamp()
+        except ValueError:
+            return time.time()
+
+    def rebuild_clusters(self, now=None):
+        # O(edges); run after each sync rather than per query
+        now = now or time.time()
+        with self.lock:
+            count = len(self.addresses)
+            weights = [weight * math.exp(-self.decay_rate * max(0.0, now - last))
+                       for weight, last in zip(self.edge_weight, self.edge_last)]
+            strongest = array('d', [0.0]) * count
+            for edge_id, weight in enumerate(weights):
+                id_a, id_b = self.edge_a[edge_id], self.edge_b[edge_id]
+                strongest[id_a] = max(strongest[id_a], weight)
+                strongest[id_b] = max(strongest[id_b], weight)
+
+            parent = array('I', range(count))
+
+            def find(contact_id):
+                while parent[contact_id] != contact_id:
+                    parent[contact_id] = parent[parent[contact_id]]
+                    contact_id = parent[contact_id]
+                return contact_id
+
+            for edge_id, weight in enumerate(weights):
+                id_a, id_b = self.edge_a[edge_id], self.edge_b[edge_id]
+                if weight >= CLUSTER_MIN_WEIGHT and weight >= CLUSTER_RELATIVE_WEIGHT * max(strongest[id_a], strongest[id_b]):
+                    root_a, root_b = find(id_a), find(id_b)
+                    if root_a != root_b:
+                        parent[root_b] = root_a
+
+            groups = {}
+            for contact_id in range(count):
+                groups.setdefault(find(contact_id), []).append(contact_id)
+
+            clusters = sorted((members for members in groups.values() if len(members) > 1), key=len, reverse=True)[:CLUSTER_LIMIT]
+            # Most active members first
+            self.cluster_cache = [sorted(members, key=lambda contact_id: -self.rank[contact_id]) for members in clusters]
+
+    # Queries
+
+    def _score(self, contact_id: int, now: float):
+        return self.weight[contact_id] * math.exp(-self.decay_rate * max(0.0, now - self.last_seen[contact_id]))
+
+    def _contact_summary(self, contact_id: int, now: float):
+        return {
+            'address': self.addresses[contact_id],
+            'score': round(self._score(contact_id, now), 4),
+            'messages_from': self.sent[contact_id],
+            'messages_to': self.addressed[contact_id],
+            'messages_with': self.shared[contact_id],
+            'last_seen': datetime.fromtimestamp(self.last_seen[contact_id]).astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
+        }
+
+    def _top_correspondents(self, k: int, now: float):
+        return [self._contact_summary(contact_id, now) for _, contact_id in self.ranking[:k]]
+
+    def _clusters(self, n: int, max_members: int):
+        return [
+            {'size': len(members), 'members': [self.addresses[contact_id] for contact_id in members[:max_members]]}
+            for members in self.cluster_cache[:n]
+        ]
+
+    def top_correspondents(self, k: int = 10, now=None):
+        now = now or time.time()
+        with self.lock:
+            return self._top_correspondents(k, now)
+
+    def contact(self, address: str, k: int = 10, now=None):
+        now = now or time.time()
+        with self.lock:
+            contact_id = self.ids.get((address or '').strip().lower())
+            if contact_id is None:
+                return None
+
+            neighbours = self.neighbours[contact_id]
+            summary = self._contact_summary(contact_id, now)
+            summary['top_co_participants'] = [
+                {'address': self.addresses[other_id], 'shared_messages': neighbours[other_id]}
+                for other_id in heapq.nlargest(k, neighbours, key=neighbours.get)
+            ]
+            return summary
+
+    def clusters(self, n: int = 5, max_members: int = CLUSTER_MEMBER_LIMIT):
+        with self.lock:
+            return self._clusters(n, max_members)
+
+    def summary(self, k: int = 10, now=None):
+        now = now or time.time()
+        with self.lock:
+            return {
+                'indexed_messages': self.indexed_messages,
+                'contacts': len(self.addresses),
+                'top_correspondents': self._top_correspondents(k, now),
+                'co_recipient_clusters': self._clusters(5, CLUSTER_MEMBER_LIMIT)
+            }
+
+
+# Keeps an InteractionIndex current by periodically fetching the inbox and sent
+# items received since the last sync, so queries can be answered from the index alone
+class IndexSync:
+    def __init__(self, config: SectionProxy, index: InteractionIndex, interval: float = 300, initial_days: int = 90):
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+
+        self.settings = config
+        self.index = index
+        self.interval = interval
+        self.initial_days = initial_days
+
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='network-index-sync', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self._serve())
+
+    async def _serve(self):
+        # The Graph client must be created on the loop that will use it
+        graph_instance = Graph(self.settings)
+        while True:
+            try:
+                await self.sync(graph_instance)
+            except Exception:
+                logger.exception('Communication network index sync failed')
+            await asyncio.sleep(self.interval)
+
+    async def sync(self, graph_instance: Graph):
+        # The owner is on every message; they must be known before anything is indexed
+        if self.index.owner is None:
+            user = await graph_instance.get_user()
+            if not (user and (user.mail or user.user_principal_name)):
+                raise RuntimeError('Could not determine the mailbox owner address')
+            self.index.owner = (user.mail or user.user_principal_name).lower()
+
+        for folder in SYNC_FOLDERS:
+            synced_until = self.index.synced_until.get(folder)
+            if synced_until:
+                # Inclusive bound: messages at the boundary second are deduplicated by id
+                since = datetime.fromtimestamp(synced_until, timezone.utc)
+            else:
+                since = datetime.now(timezone.utc) - timedelta(days=self.initial_days)
+            metadata = await graph_instance.get_email_metadata_since(folder, since)
+            self.index.update(metadata, folder)
+        self.index.rebuild_clusters()
@@ -141,6 +141,21 @@ extract_sharepoint_usage_declaration = types.FunctionDeclaration(
     },
 )
 
+get_communication_network_declaration = types.FunctionDeclaration(
+    name="get_communication_network",
+    description="Get who the user communicates with most: top correspondents, interaction counts, recency and groups of people who are emailed together. Optionally focus on a single contact",
+    parameters={
+        "type": "OBJECT",
+        "properties": {
+            "contact": {
+                "type": "STRING",
+                "description": "Email address of a contact to get interaction details for; leave empty for the overall network",
+            },
+        },
+        "required": [],
+    },
+)
+
 # Define the tool
 api_tool = types.Tool(
     function_declarations=[
@@ -151,6 +166,7 @@ api_tool = types.Tool(
         extract_calendar_events_declaration,
         extract_contacts_declaration,
         extract_sharepoint_usage_declaration,
+        get_communication_network_declaration,
     ],
 )
 
@@ -218,6 +234,15 @@ def extract_sharepoint_usage(search_term):
     else:
         raise Exception(f"Failed to extract SharePoint usage: {response.status_code} - {response.text}")
 
+def get_communication_network(contact=""):
+    url = f"{BASE_URL}/interact"
+    payload = {"option": 8, "search_term": contact}
+    response = requests.post(url, json=payload)
+    if response.status_code == 200:
+        return response.json()
+    else:
+        raise Exception(f"Failed to get communication network: {response.status_code} - {response.text}")
+
 # Define the functions dictionary
 functions = {
     "display_access_token": display_access_token,
@@ -227,6 +252,7 @@ functions = {
     "extract_calendar_events": extract_calendar_events,
     "extract_contacts": extract_contacts,
     "extract_sharepoint_usage": extract_sharepoint_usage,
+    "get_communication_network": get_communication_network,
 }
 
 # text qa prompt
@@ -298,6 +324,8 @@ def main():
                 try:
                     if function_name == "extract_sharepoint_usage":
                         result = functions[function_name](args["search_term"])
+                    elif function_name == "get_communication_network":
+                        result = functions[function_name]((args or {}).get("contact", ""))
                     else:
                         result = functions[function_name]()
                     